@@ -1,10 +1,24 @@
 import streamlit as st
 import os
+import io
 import time
+import hashlib
+import shutil
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from typing import Tuple, Optional
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from requests_toolbelt.multipart.encoder import MultipartEncoder, MultipartEncoderMonitor
 from urllib.parse import urljoin 
 
+# Must run before any other Streamlit command (including the secrets error below)
+st.set_page_config(page_title="Video/Audio Summarizer (ApyHub)", layout="centered")
+
 # --- Configuration and Client Initialization (assuming secrets are set) ---
 try:
     API_KEY = st.secrets["APYHUB_API_KEY"] 
@@ -15,50 +29,201 @@ except KeyError:
 APYHUB_BASE_URL = "https://api.apyhub.com/"
 STT_ENDPOINT = urljoin(APYHUB_BASE_URL, "stt/file") 
 MODEL_NAME = "ApyHub STT (multipart/form-data)" 
+HASH_CHUNK_SIZE = 1024 * 1024 # 1 MiB
+MAX_UPLOAD_SIZE = 200 * 1024 * 1024 # 200MB
+REQUEST_TIMEOUT = (10, 300) # (connect, read) seconds
+
+# Retry policy: 429/5xx responses are retried by _call_apyhub, which rebuilds the
+# streamed multipart body; urllib3 only retries connection failures (no body sent yet).
+MAX_ATTEMPTS = 4
+BACKOFF_FACTOR = 1.5
+RETRY_STATUSES = {429, 502, 503, 504}
+MAX_RETRY_DELAY = 60 # seconds; caps a server-supplied Retry-After so a worker is never parked for long
+
+# Optional local audio extraction: video (and large audio) is re-encoded to 16 kHz mono
+# Opus before upload when ffmpeg is on the PATH; otherwise the original file is sent.
+FFMPEG_PATH = shutil.which("ffmpeg")
+AUDIO_PASSTHROUGH_LIMIT = 10 * 1024 * 1024 # audio at or below this size is uploaded as-is
+VIDEO_EXTENSIONS = {"mp4", "mov", "mkv", "avi", "flv", "wmv", "webm"}
+FFMPEG_TIMEOUT = 300 # seconds; on timeout the original file is uploaded instead
+FFMPEG_AUDIO_ARGS = ["-vn", "-ac", "1", "-ar", "16000", "-c:a", "libopus", "-b:a", "24k", "-f", "ogg"]
+
+# Fallback MIME types, used when the browser reports none or a generic octet-stream
+MIME_BY_EXT = {
+    "mp3": "audio/mpeg",
+    "wav": "audio/wav",
+    "mp4": "video/mp4",
+    "mov": "video/quicktime",
+    "m4a": "audio/m4a",
+    "ogg": "audio/ogg",
+}
+
+# --- Shared HTTP Session (keep-alive connection pool, reused across reruns) ---
+
+@st.cache_resource
+def get_http_session() -> requests.Session:
+    session = requests.Session()
+    retry = Retry(total=3, connect=3, read=0, status=0, other=0, backoff_factor=BACKOFF_FACTOR)
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=retry)
+    session.mount("https://", adapter)
+    return session
+
+SESSION = get_http_session()
+
+# --- Shared Worker Pool (uploads run off the script thread so the UI stays responsive) ---
+
+@st.cache_resource
+def get_executor() -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="apyhub")
+
+EXECUTOR = get_executor()
+POLL_INTERVAL = 0.5 # seconds between reruns while a transcription is in flight
+
+# Custom styling; the accent colour also lives in .streamlit/config.toml (theme.primaryColor).
+# Emitted on every run on purpose: Streamlit drops elements that a rerun does not re-emit.
+CUSTOM_CSS = """
+<style>
+    .stButton>button {
+        background-color: #38B000; 
+        color: white;
+        font-size: 16px;
+        padding: 10px 24px;
+        border-radius: 8px;
+        transition: background-color 0.3s;
+        box-shadow: 0 4px 6px rgba(0, 0, 0, 0.1);
+    }
+    .stButton>button:hover {
+        background-color: #2D8B00;
+    }
+    .main-header {
+        color: #38B000; 
+        font-weight: bold;
+        text-align: center;
+        padding-bottom: 10px;
+        border-bottom: 2px solid #e0e0e0;
+    }
+</style>
+"""
 
 # --- Utility Function: Core Logic ---
 
-def analyze_media_with_apyhub(uploaded_file, mime_type: str, language_code: str) -> Tuple[Optional[str], str]:
-    
-    st.info(f"Step 1/2: Preparing file **{uploaded_file.name}** for ApyHub...")
+class TranscriptionCancelled(Exception):
+    # Raised on the worker thread when the user clicks Cancel.
+    pass
+
+def retry_delay(response: requests.Response, attempt: int) -> float:
+    # Honour a numeric Retry-After header (sent with 429s, capped), else exponential backoff.
+    retry_after = response.headers.get("Retry-After", "")
+    if retry_after.isdigit():
+        return min(float(retry_after), MAX_RETRY_DELAY)
+    return BACKOFF_FACTOR * (2 ** attempt)
+
+def file_digest(uploaded_file) -> str:
+    # BLAKE2b over 1 MiB slices of the upload. getvalue() returns the bytes UploadedFile
+    # shares with Streamlit's record; getbuffer() would force a private copy of the whole file.
+    digest = hashlib.blake2b(digest_size=16)
+    view = memoryview(uploaded_file.getvalue())
+    for offset in range(0, len(view), HASH_CHUNK_SIZE):
+        digest.update(view[offset:offset + HASH_CHUNK_SIZE])
+    return digest.hexdigest()
+
+def extract_audio(uploaded_file, filename: str, mime_type: str) -> Optional[bytes]:
+    # Returns the Opus/Ogg audio track, or None to upload the original file unchanged.
+    ext = os.path.splitext(filename)[1].lower().replace('.', '')
+    is_video = mime_type.startswith("video/") or ext in VIDEO_EXTENSIONS
+    if FFMPEG_PATH is None or (not is_video and uploaded_file.size <= AUDIO_PASSTHROUGH_LIMIT):
+        return None
     
-    # 1. Prepare data for multipart/form-data
-    uploaded_file.seek(0)
-    file_content = uploaded_file.read() # Read the content once
+    # A temp file (not pipe:0) because MP4/MOV with a trailing moov atom cannot be read from a pipe.
+    with tempfile.NamedTemporaryFile(suffix=f".{ext}") as source:
+        source.write(uploaded_file.getvalue()) # shared bytes; getbuffer() would copy the upload
+        source.flush()
+        try:
+            result = subprocess.run(
+                [FFMPEG_PATH, "-nostdin", "-loglevel", "error", "-i", source.name, *FFMPEG_AUDIO_ARGS, "pipe:1"],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL,
+                timeout=FFMPEG_TIMEOUT,
+            )
+        except subprocess.TimeoutExpired:
+            return None
     
-    # ✅ FIX APPLIED: Changed parameter name from 'file' to 'stt_file' 
-    files = {
-        'stt_file': (uploaded_file.name, file_content, mime_type) 
-    }
+    if result.returncode != 0 or not result.stdout:
+        return None
+    return result.stdout
+
+@st.cache_data(show_spinner=False, max_entries=32)
+def _call_apyhub(file_hash: str, _uploaded_file, _filename: str, mime_type: str, language_code: str, _progress: dict, _cancel: threading.Event) -> dict:
+    # Cached on (file_hash, mime_type, language_code); the leading underscores tell Streamlit
+    # not to hash the file object, its name (same bytes under a new name is a hit),
+    # the progress dict or the cancel event. Errors raise and are not cached.
     
-    # The 'language' field is a simple form field.
-    data = {
-        'language': language_code
-    }
+    upload, filename = _uploaded_file, _filename
+    audio = extract_audio(_uploaded_file, filename, mime_type)
+    if audio is not None:
+        upload = io.BytesIO(audio)
+        filename = os.path.splitext(filename)[0] + ".ogg"
+        mime_type = "audio/ogg"
     
-    # The Authorization token is passed via a header.
-    headers = {
-        "apy-token": API_KEY, 
-    }
+    for attempt in range(MAX_ATTEMPTS):
+        if _cancel.is_set():
+            raise TranscriptionCancelled()
+        
+        # 1. Prepare data for multipart/form-data (rebuilt per attempt: the body is a one-shot stream)
+        upload.seek(0)
+        
+        # ✅ FIX APPLIED: Changed parameter name from 'file' to 'stt_file' 
+        # The file object is handed over as-is so the body is streamed in chunks
+        # instead of being read fully into memory first.
+        # The 'language' field is a simple form field.
+        encoder = MultipartEncoder(fields={
+            'language': language_code,
+            'stt_file': (filename, upload, mime_type),
+        })
+        # Upload progress is published to _progress for the script thread to render;
+        # raising from the callback aborts the upload when the user cancels.
+        def on_read(m: MultipartEncoderMonitor) -> None:
+            if _cancel.is_set():
+                raise TranscriptionCancelled()
+            _progress.update(fraction=min(m.bytes_read / m.len, 1.0))
+        monitor = MultipartEncoderMonitor(encoder, on_read)
+        
+        # The Authorization token is passed via a header.
+        headers = {
+            "apy-token": API_KEY, 
+            "Content-Type": monitor.content_type,
+        }
 
-    transcript_text = None
-    
-    try:
         # 2. Call ApyHub for Speech-to-Text
-        st.info(f"Step 2/2: Calling ApyHub STT API at **{STT_ENDPOINT}** with language code: `{language_code}`...")
-        start_time = time.time()
-        
-        response = requests.post(
+        response = SESSION.post(
             STT_ENDPOINT, 
             headers=headers, 
-            data=data,
-            files=files,
-            timeout=300 
+            data=monitor,
+            timeout=REQUEST_TIMEOUT
         )
         
-        response.raise_for_status() 
-        
-        transcript_data = response.json()
+        if response.status_code not in RETRY_STATUSES or attempt == MAX_ATTEMPTS - 1:
+            break
+        if _cancel.wait(retry_delay(response, attempt)):
+            raise TranscriptionCancelled()
+    
+    response.raise_for_status() 
+    
+    return orjson.loads(response.content)
+
+
+def transcribe_media(uploaded_file, mime_type: str, language_code: str, progress: dict, cancel: threading.Event) -> dict:
+    # Runs on a worker thread: hashing and the HTTP call only, no Streamlit elements.
+    file_hash = file_digest(uploaded_file)
+    return _call_apyhub(file_hash, uploaded_file, uploaded_file.name, mime_type, language_code, progress, cancel)
+
+
+def analyze_media_with_apyhub(future: Future, language_code: str, start_time: float) -> Tuple[Optional[str], str]:
+    
+    transcript_text = None
+    
+    try:
+        transcript_data = future.result()
         transcript_text = transcript_data.get("data")
 
         if not transcript_text:
@@ -80,7 +245,7 @@ def analyze_media_with_apyhub(uploaded_file, mime_type: str, language_code: str)
         return final_result, language_code
             
     except requests.exceptions.HTTPError as e: 
-        st.error(f"ApyHub API Call Failed (HTTP Error): {e}. Response: {response.text}")
+        st.error(f"ApyHub API Call Failed (HTTP Error): {e}. Response: {e.response.text}")
         st.error("Common ApyHub errors: 401 (Invalid Token), 400 (Missing 'language' parameter or invalid file).")
         return "Analysis failed due to API connection error. Check your API key and mandatory parameters.", ""
     except requests.exceptions.RequestException as e:
@@ -91,32 +256,18 @@ def analyze_media_with_apyhub(uploaded_file, mime_type: str, language_code: str)
         return "Analysis failed due to an unexpected error.", ""
 
 
-# --- Streamlit UI (Rest of the code remains the same as it was already correct) ---
-st.set_page_config(page_title="Video/Audio Summarizer (ApyHub)", layout="centered")
+def cancel_transcription() -> None:
+    # Button callback: drops the pending job before the script reruns.
+    job = st.session_state.pop("transcription", None)
+    if job is not None:
+        job["cancel"].set()
+        job["future"].cancel()
+        st.session_state["transcription_cancelled"] = True
 
-st.markdown("""
-<style>
-    .stButton>button {
-        background-color: #38B000; 
-        color: white;
-        font-size: 16px;
-        padding: 10px 24px;
-        border-radius: 8px;
-        transition: background-color 0.3s;
-        box-shadow: 0 4px 6px rgba(0, 0, 0, 0.1);
-    }
-    .stButton>button:hover {
-        background-color: #2D8B00;
-    }
-    .main-header {
-        color: #38B000; 
-        font-weight: bold;
-        text-align: center;
-        padding-bottom: 10px;
-        border-bottom: 2px solid #e0e0e0;
-    }
-</style>
-""", unsafe_allow_html=True)
+
+# --- Streamlit UI (transcriptions run on the worker pool and are polled at the bottom) ---
+
+st.markdown(CUSTOM_CSS, unsafe_allow_html=True)
 
 
 st.markdown(f'<h1 class="main-header">🎙️Video/Audio Summarizer (via ApyHub)</h1>', unsafe_allow_html=True)
@@ -147,6 +298,13 @@ language_selection = st.selectbox(
 
 selected_language_code = language_selection.split("(")[-1].replace(")", "")
 
+# A finished job is taken out of session state before the Generate button is rendered,
+# so the button is re-enabled on the same run that shows the result (or error).
+job = st.session_state.get("transcription")
+finished_job = None
+if job is not None and job["future"].done():
+    finished_job = st.session_state.pop("transcription")
+
 if uploaded_file is not None:
     # Determine MIME type 
     mime_type = uploaded_file.type 
@@ -154,28 +312,59 @@ if uploaded_file is not None:
     # Fallback logic for MIME type (kept for robustness)
     if not mime_type or 'octet-stream' in mime_type:
         ext = os.path.splitext(uploaded_file.name)[1].lower().replace('.', '')
-        if ext == 'mp3': mime_type = 'audio/mpeg'
-        elif ext == 'wav': mime_type = 'audio/wav'
-        elif ext == 'mp4': mime_type = 'video/mp4'
-        elif ext == 'mov': mime_type = 'video/quicktime'
-        elif ext == 'm4a': mime_type = 'audio/m4a'
-        elif ext == 'ogg': mime_type = 'audio/ogg'
-        else: mime_type = 'application/octet-stream' 
+        mime_type = MIME_BY_EXT.get(ext, 'application/octet-stream')
         
-    st.success(f"File uploaded: **{uploaded_file.name}** (Detected MIME: `{mime_type}`) - Ready to process.")
+    # Size gate runs as soon as the file is uploaded, before the user can click Generate
+    file_too_large = uploaded_file.size > MAX_UPLOAD_SIZE
+    if file_too_large:
+        st.error("File size limit exceeded. Please upload a file smaller than 200MB.")
+    else:
+        st.success(f"File uploaded: **{uploaded_file.name}** (Detected MIME: `{mime_type}`) - Ready to process.")
     
-    if st.button("Generate Transcript and Summary"):
+    if st.button("Generate Transcript and Summary", disabled=file_too_large or "transcription" in st.session_state):
         
-        if uploaded_file.size > (200 * 1024 * 1024): 
-            st.error("File size limit exceeded. Please upload a file smaller than 200MB.")
-        else:
-            # Main processing function call
-            with st.spinner(f"Processing with ApyHub..."):
-                analysis_result, _ = analyze_media_with_apyhub(uploaded_file, mime_type, selected_language_code)
-            
-            # Display the result
-            if analysis_result and not analysis_result.startswith("Analysis failed"):
-                st.markdown(analysis_result)
-                st.success(f"Process complete: Transcription extracted by ApyHub.")
-            else:
-                st.error("The analysis failed. Please check the error messages above for details.")
+        # Main processing function call (submitted to the worker pool, polled below)
+        progress = {"fraction": 0.0}
+        cancel = threading.Event()
+        st.session_state["transcription"] = {
+            "future": EXECUTOR.submit(transcribe_media, uploaded_file, mime_type, selected_language_code, progress, cancel),
+            "progress": progress,
+            "cancel": cancel,
+            "file_name": uploaded_file.name,
+            "language_code": selected_language_code,
+            "start_time": time.time(),
+        }
+
+# Poll the in-flight transcription without blocking the script thread
+job = st.session_state.get("transcription")
+if job is not None:
+    # One status that follows the job's phase: no bytes sent yet (hashing / audio
+    # extraction), uploading, then upload complete and waiting for the transcript.
+    fraction = job["progress"]["fraction"]
+    elapsed = time.time() - job["start_time"]
+    if fraction == 0.0:
+        label = f"Step 1/2: Preparing file **{job['file_name']}** for ApyHub..."
+    elif fraction < 1.0:
+        label = f"Step 2/2: Uploading to ApyHub STT API with language code: `{job['language_code']}`..."
+    else:
+        label = "Step 2/2: Upload complete. Waiting for the transcript from ApyHub..."
+    
+    with st.status(f"{label} ({elapsed:.0f}s elapsed)", state="running", expanded=True):
+        st.progress(fraction, text=f"{fraction:.0%} uploaded to **{STT_ENDPOINT}**")
+        # on_click runs before the next script run, so Generate is already enabled on that run
+        st.button("Cancel", on_click=cancel_transcription)
+    
+    # No spinner around the sleep: st.spinner only renders after its own 0.5 s delay
+    time.sleep(POLL_INTERVAL)
+    st.rerun()
+elif st.session_state.pop("transcription_cancelled", False):
+    st.warning("Transcription cancelled. If the upload had already finished, ApyHub's reply will be discarded.")
+elif finished_job is not None:
+    analysis_result, _ = analyze_media_with_apyhub(finished_job["future"], finished_job["language_code"], finished_job["start_time"])
+    
+    # Display the result
+    if analysis_result and not analysis_result.startswith("Analysis failed"):
+        st.markdown(analysis_result)
+        st.success(f"Process complete: Transcription extracted by ApyHub.")
+    else:
+        st.error("The analysis failed. Please check the error messages above for details.")